@@ -2,10 +2,13 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import json
+import orjson
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-import itertools
-from io import StringIO
-import requests
+import heapq
+import os
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit
 
 # ページ設定
 st.set_page_config(page_title="トウモロコシ運搬船バース最適化", layout="wide")
@@ -17,6 +20,143 @@ def get_usd_jpy_rate():
     # 実際の実装では為替APIを使用してください
     return 150.0  # 仮の為替レート
 
+# ルート評価カーネル（JITコンパイル）
+@njit(cache=True, fastmath=False)
+def _score_route(route_idx, capacity, stock, usage, deliv_cap, change_cost):
+    """ルートの実行可能性・コストと各バースの納入日数・利用可能容量・納入量を計算"""
+    n = route_idx.shape[0]
+    days = np.full(n, -1, dtype=np.int64)
+    available = np.zeros(n, dtype=np.int64)
+    amounts = np.zeros(n, dtype=np.int64)
+    cost = 0
+    
+    for i in range(n):
+        # バース変更コスト
+        if i > 0:
+            cost += change_cost
+        
+        s = route_idx[i]
+        projected_stock = max(0, stock[s] - usage[s] * i)
+        available[i] = capacity[s] - projected_stock
+        
+        # 利用不可のバースに到達した時点で打ち切り
+        if available[i] < deliv_cap:
+            return False, cost, days[:i + 1], available[:i + 1], amounts[:i + 1]
+        
+        days[i] = i
+        amounts[i] = min(deliv_cap, available[i])
+    
+    return True, cost, days, available, amounts
+
+@njit(cache=True)
+def _worst_slot(best_cost, best_len, best_seq, count):
+    """上位候補の中で最も順位の低いスロットを返す（コスト→バース数→発見順）"""
+    worst = 0
+    for k in range(1, count):
+        if best_cost[k] != best_cost[worst]:
+            if best_cost[k] > best_cost[worst]:
+                worst = k
+        elif best_len[k] != best_len[worst]:
+            if best_len[k] > best_len[worst]:
+                worst = k
+        elif best_seq[k] > best_seq[worst]:
+            worst = k
+    return worst
+
+# ルートはuint64 1語に詰めて扱う: i番目のバースのサイロ番号をビット[8i, 8i+8)、バース数をビット[56, 64)に格納
+ROUTE_FIELD_BITS = 8
+ROUTE_LEN_SHIFT = 56
+# 使用済みサイロをint64のビットマスクで管理するための上限
+# 同コスト枝の打ち切りにより、変更コスト0でも64サイロまで全探索にはならない
+MAX_SILOS = 64
+
+def unpack_route(packed):
+    """uint64に詰めたルートをサイロ番号のタプルに戻す"""
+    packed = int(packed)
+    length = packed >> ROUTE_LEN_SHIFT
+    mask = (1 << ROUTE_FIELD_BITS) - 1
+    return tuple((packed >> (ROUTE_FIELD_BITS * i)) & mask for i in range(length))
+
+@njit(cache=True, nogil=True)
+def _search_subtree(first, ready_day, max_len, change_cost, top_k):
+    """先頭バースを固定した部分木を分枝限定法で探索し、上位top_k件のルート（uint64に詰めたもの）を返す
+    
+    部分木内は辞書順に探索するため、同コスト・同バース数のルートは発見順がそのまま順位になる。
+    """
+    n = ready_day.shape[0]
+    field_bits = np.uint64(ROUTE_FIELD_BITS)
+    field_mask = np.uint64((1 << ROUTE_FIELD_BITS) - 1)
+    len_shift = np.uint64(ROUTE_LEN_SHIFT)
+    
+    best_routes = np.zeros(top_k, dtype=np.uint64)
+    best_len = np.zeros(top_k, dtype=np.int64)
+    best_cost = np.zeros(top_k, dtype=np.int64)
+    best_seq = np.zeros(top_k, dtype=np.int64)
+    count = 0
+    worst = 0
+    
+    next_silo = np.zeros(max_len + 1, dtype=np.int64)
+    route = np.uint64(first)
+    used = np.int64(1) << first
+    depth = 1
+    seq = 0
+    
+    # 先頭バースのみのルート
+    best_routes[0] = route | (np.uint64(1) << len_shift)
+    best_len[0] = 1
+    count = 1
+    
+    while depth > 0:
+        cost = depth * change_cost  # 次のバースを追加した場合のコスト
+        s = next_silo[depth]
+        
+        # 探索し尽くした、または上位top_k件に入り得ない枝は打ち切って戻る
+        # 同コストでもバース数が最下位候補以上なら、発見順が後なので順位で上回れない
+        pruned = count == top_k and (
+            cost > best_cost[worst] or (cost == best_cost[worst] and depth + 1 >= best_len[worst])
+        )
+        if depth == max_len or s == n or pruned:
+            next_silo[depth] = 0
+            depth -= 1
+            shift = field_bits * np.uint64(depth)
+            used &= ~(np.int64(1) << np.int64((route >> shift) & field_mask))
+            route &= ~(field_mask << shift)
+            continue
+        
+        next_silo[depth] = s + 1
+        if (used >> s) & 1 or ready_day[s] > depth:
+            continue
+        
+        route |= np.uint64(s) << (field_bits * np.uint64(depth))
+        used |= np.int64(1) << s
+        depth += 1
+        seq += 1
+        
+        if count < top_k:
+            slot = count
+            count += 1
+        elif cost < best_cost[worst] or (cost == best_cost[worst] and depth < best_len[worst]):
+            slot = worst
+        else:
+            slot = -1
+        
+        if slot >= 0:
+            best_routes[slot] = route | (np.uint64(depth) << len_shift)
+            best_len[slot] = depth
+            best_cost[slot] = cost
+            best_seq[slot] = seq
+            if count == top_k:
+                worst = _worst_slot(best_cost, best_len, best_seq, count)
+    
+    return best_routes[:count], best_cost[:count]
+
+@st.cache_resource
+def warm_up_kernels():
+    """JITカーネルを事前コンパイル（初回実行時のコンパイル待ちを回避）"""
+    dummy = np.zeros(1, dtype=np.int64)
+    _score_route(np.zeros(1, dtype=np.int32), dummy, dummy, dummy, 0, 0)
+    _search_subtree(np.int64(0), dummy, 1, 0, 1)
+
 # データクラス
 class SiloData:
     def __init__(self, name, capacity, current_stock, daily_usage):
@@ -24,91 +164,145 @@ class SiloData:
         self.capacity = capacity
         self.current_stock = current_stock
         self.daily_usage = daily_usage
-        
-    def get_available_capacity(self, days_from_start):
-        """指定日数後の利用可能容量を計算"""
-        projected_stock = max(0, self.current_stock - (self.daily_usage * days_from_start))
-        return self.capacity - projected_stock
-    
-    def is_available(self, days_from_start, required_capacity):
-        """指定日数後に必要容量が利用可能かチェック"""
-        return self.get_available_capacity(days_from_start) >= required_capacity
+
+@dataclass
+class SiloTable:
+    """サイロ群を列指向（NumPy配列）で保持するテーブル"""
+    names: list[str]
+    capacity: np.ndarray
+    current_stock: np.ndarray
+    daily_usage: np.ndarray
+
+    @classmethod
+    def from_silos(cls, silos):
+        """SiloDataの列からテーブルを構築"""
+        silos = list(silos)
+        return cls(
+            names=[silo.name for silo in silos],
+            capacity=np.array([silo.capacity for silo in silos], dtype=np.int64),
+            current_stock=np.array([silo.current_stock for silo in silos], dtype=np.int64),
+            daily_usage=np.array([silo.daily_usage for silo in silos], dtype=np.int64),
+        )
 
 class RouteOptimizer:
-    def __init__(self, silos, berth_change_cost_usd, delivery_capacity_per_berth):
-        self.silos = silos
+    def __init__(self, silo_table, silo_index, berth_change_cost_usd, delivery_capacity_per_berth, usd_jpy_rate,
+                 parallelism=os.cpu_count()):
+        self.silo_table = silo_table
+        self.silo_index = silo_index
         self.berth_change_cost_usd = berth_change_cost_usd
         self.delivery_capacity_per_berth = delivery_capacity_per_berth
+        self.usd_jpy_rate = usd_jpy_rate
+        self.parallelism = parallelism or 1
+        
+        if berth_change_cost_usd < 0:
+            raise ValueError("バース変更コストは0以上である必要があります")
+        if np.any(silo_table.daily_usage < 0):
+            raise ValueError("1日使用量は0以上である必要があります")
         
-    def generate_route_plans(self, max_berth_changes):
-        """可能なルートプランを生成"""
-        plans = []
-        silo_names = list(self.silos.keys())
+        # 各サイロが納入容量を受け入れ可能になる最初の日（在庫は減る一方なので以降は常に受け入れ可能）
+        # 在庫が減らない、または容量自体が納入容量未満のサイロは受け入れ不可
+        shortfall = silo_table.current_stock + delivery_capacity_per_berth - silo_table.capacity
+        usage = np.maximum(silo_table.daily_usage, 1)
+        never = (silo_table.capacity < delivery_capacity_per_berth) | ((shortfall > 0) & (silo_table.daily_usage <= 0))
+        self.ready_day = np.where(
+            never,
+            np.iinfo(np.int64).max,
+            np.maximum(0, -(-shortfall // usage))
+        ).astype(np.int64)
         
-        # 1回から最大変更回数+1回までのバース使用パターンを生成
-        for num_berths in range(1, min(max_berth_changes + 2, len(silo_names) + 1)):
-            for berth_combination in itertools.combinations(silo_names, num_berths):
-                for berth_order in itertools.permutations(berth_combination):
-                    plans.append(list(berth_order))
+    def search(self, max_berth_changes, start_date, top_k=10):
+        """分枝限定法で低コストの実行可能ルートを上位top_k件探索"""
+        table = self.silo_table
+        num_silos = len(table.names)
+        max_len = min(max_berth_changes + 1, num_silos)
         
-        return plans
+        # ルートをuint64に詰めるため、サイロ数とバース数に上限がある
+        if num_silos > MAX_SILOS:
+            raise ValueError(f"サイロは最大{MAX_SILOS}個までです")
+        if max_len > ROUTE_LEN_SHIFT // ROUTE_FIELD_BITS:
+            raise ValueError(f"バース数は最大{ROUTE_LEN_SHIFT // ROUTE_FIELD_BITS}までです")
+        
+        # 先頭バースごとの部分木を並列に探索（カーネルはGILを解放する）
+        first_silos = np.flatnonzero(self.ready_day <= 0)
+        change_cost = int(self.berth_change_cost_usd)
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            subtrees = list(executor.map(
+                lambda first: _search_subtree(first, self.ready_day, max_len, change_cost, top_k),
+                first_silos
+            ))
+        
+        # 部分木ごとの上位候補を統合（コスト→バース数→順列の辞書順、itertools.permutationsと同じ並び）
+        candidates = []
+        for routes, costs in subtrees:
+            for packed, cost in zip(routes, costs):
+                route = unpack_route(packed)
+                candidates.append((int(cost), len(route), route))
+        top = heapq.nsmallest(top_k, candidates)
+        
+        # 納入日の文字列は全ルートで共通なので一度だけ作成
+        date_strs = self.date_strings(start_date, max_len)
+        return [
+            self.describe_route(tuple(table.names[idx] for idx in route), start_date, date_strs)
+            for _, _, route in top
+        ]
+    
+    def date_strings(self, start_date, num_days):
+        """起算日からnum_days日分の納入日文字列を作成"""
+        return [(start_date + timedelta(days=day)).strftime('%Y-%m-%d') for day in range(num_days)]
     
-    def evaluate_route(self, route, start_date):
-        """ルートを評価"""
-        total_cost = 0
-        current_day = 0
+    def describe_route(self, route, start_date, date_strs=None):
+        """ルートを評価し、表示用の詳細スケジュールを作成"""
+        if date_strs is None:
+            date_strs = self.date_strings(start_date, len(route))
+        
+        table = self.silo_table
+        route_idx = np.array([self.silo_index[name] for name in route], dtype=np.int32)
+        feasible, total_cost, days, available, amounts = _score_route(
+            route_idx, table.capacity, table.current_stock, table.daily_usage,
+            int(self.delivery_capacity_per_berth), int(self.berth_change_cost_usd)
+        )
+        
         results = []
+        for i in range(len(days)):
+            step_feasible = bool(days[i] >= 0)
+            results.append({
+                'バース': route[i],
+                '納入日': date_strs[days[i]] if step_feasible else 'N/A',
+                '納入量': int(amounts[i]),
+                '利用可能容量': int(available[i]),
+                '実行可能': step_feasible
+            })
         
-        for i, berth_name in enumerate(route):
-            # バース変更コスト
-            if i > 0:
-                total_cost += self.berth_change_cost_usd
-            
-            silo = self.silos[berth_name]
-            
-            # サイロの利用可能性をチェック
-            if silo.is_available(current_day, self.delivery_capacity_per_berth):
-                delivery_date = start_date + timedelta(days=current_day)
-                available_capacity = silo.get_available_capacity(current_day)
-                delivery_amount = min(self.delivery_capacity_per_berth, available_capacity)
-                
-                results.append({
-                    'バース': berth_name,
-                    '納入日': delivery_date.strftime('%Y-%m-%d'),
-                    '納入量': delivery_amount,
-                    '利用可能容量': available_capacity,
-                    '実行可能': True
-                })
-                
-                current_day += 1
-            else:
-                results.append({
-                    'バース': berth_name,
-                    '納入日': 'N/A',
-                    '納入量': 0,
-                    '利用可能容量': silo.get_available_capacity(current_day),
-                    '実行可能': False
-                })
-                
-                return {
-                    'route': route,
-                    'total_cost_usd': float('inf'),
-                    'total_cost_jpy': float('inf'),
-                    'feasible': False,
-                    'details': results
-                }
+        if not feasible:
+            return {
+                'route': route,
+                'total_cost_usd': float('inf'),
+                'total_cost_jpy': float('inf'),
+                'feasible': False,
+                'details': results
+            }
         
         return {
             'route': route,
             'total_cost_usd': total_cost,
-            'total_cost_jpy': total_cost * get_usd_jpy_rate(),
+            'total_cost_jpy': total_cost * self.usd_jpy_rate,
             'feasible': True,
             'details': results
         }
 
+@st.cache_data
+def run_optimization(silos_tuple, max_berth_changes, berth_change_cost, delivery_capacity, start_date, usd_jpy_rate):
+    """最適化を実行（入力が同じ場合は前回の結果を再利用）"""
+    silo_table = SiloTable.from_silos(SiloData(*silo) for silo in silos_tuple)
+    silo_index = {name: idx for idx, name in enumerate(silo_table.names)}
+    
+    optimizer = RouteOptimizer(silo_table, silo_index, berth_change_cost, delivery_capacity, usd_jpy_rate)
+    return optimizer.search(max_berth_changes, start_date)
+
 # メイン関数
 def main():
     st.title("🚢 トウモロコシ運搬船バース最適化システム")
+    warm_up_kernels()
     
     # サイドバーでの設定
     st.sidebar.header("📋 システム設定")
@@ -119,7 +313,7 @@ def main():
     
     # 基本設定
     max_berth_changes = st.sidebar.slider("最大バース変更回数", 1, 5, 3)
-    berth_change_cost = st.sidebar.number_input("バース変更コスト (USD)", value=10000, step=1000)
+    berth_change_cost = st.sidebar.number_input("バース変更コスト (USD)", min_value=0, value=10000, step=1000)
     delivery_capacity = st.sidebar.number_input("バースあたり納入容量", value=1000, step=100)
     
     # 起算日設定
@@ -129,30 +323,50 @@ def main():
     input_mode = st.sidebar.radio("データ入力方式", ["手動入力", "ファイル読み込み"])
     
     if input_mode == "手動入力":
-        # サイロ数設定
-        num_silos = st.sidebar.slider("サイロ数", 2, 10, 5)
-        
         # メインエリア
         st.header("🏭 サイロ情報設定")
         
-        # サイロ情報入力
+        # サイロ情報入力（表形式でまとめて編集、行の追加・削除でサイロ数を変更）
+        num_silos = 5
+        default_df = pd.DataFrame({
+            'サイロ名': [f"サイロ_{i+1}" for i in range(num_silos)],
+            '容量': [5000] * num_silos,
+            '現在在庫': [2000] * num_silos,
+            '1日使用量': [200] * num_silos
+        })
+        edited_df = st.data_editor(
+            default_df,
+            num_rows='dynamic',
+            key='silo_editor',
+            column_config={
+                '容量': st.column_config.NumberColumn(min_value=1, step=100),
+                '現在在庫': st.column_config.NumberColumn(min_value=0, step=100),
+                '1日使用量': st.column_config.NumberColumn(min_value=0, max_value=5000, step=1)
+            }
+        ).dropna()
+        
+        # 手動入力は従来どおり最大10サイロまで
+        if len(edited_df) > 10:
+            st.error("❌ 手動入力のサイロは最大10個までです")
+            return
+        
         silos = {}
-        cols = st.columns(2)
-        
-        for i in range(num_silos):
-            with cols[i % 2]:
-                st.subheader(f"サイロ {i+1}")
-                name = st.text_input(f"サイロ名", f"サイロ_{i+1}", key=f"silo_name_{i}")
-                capacity = st.number_input(f"容量", value=5000, step=100, key=f"capacity_{i}")
-                current_stock = st.number_input(f"現在の在庫", value=2000, step=100, key=f"stock_{i}")
-                daily_usage = st.slider(f"1日あたり使用量", 0, 5000, 200, key=f"usage_{i}")
-                
-                silos[name] = SiloData(name, capacity, current_stock, daily_usage)
-                
-                # 容量使用率表示
-                usage_rate = (current_stock / capacity) * 100
-                st.progress(usage_rate / 100)
-                st.write(f"使用率: {usage_rate:.1f}%")
+        for row in edited_df.itertuples(index=False):
+            name, capacity, current_stock, daily_usage = row
+            silos[name] = SiloData(name, int(capacity), int(current_stock), int(daily_usage))
+        
+        # 容量使用率表示
+        silo_list = list(silos.values())
+        st.dataframe(
+            pd.DataFrame({
+                'サイロ名': [silo.name for silo in silo_list],
+                '使用率': [(silo.current_stock / silo.capacity) * 100 for silo in silo_list]
+            }),
+            column_config={
+                '使用率': st.column_config.ProgressColumn(format='%.1f%%', min_value=0, max_value=100)
+            },
+            hide_index=True
+        )
     
     else:
         # ファイル読み込み
@@ -164,27 +378,31 @@ def main():
                 silos = {}
                 
                 for silo_data in data['silos']:
+                    for field in ('capacity', 'current_stock', 'daily_usage'):
+                        value = silo_data[field]
+                        if isinstance(value, bool) or not (isinstance(value, int) or (isinstance(value, float) and value.is_integer())):
+                            raise ValueError(f"{silo_data['name']}の{field}は整数である必要があります")
+                    if silo_data['daily_usage'] < 0:
+                        raise ValueError(f"{silo_data['name']}の1日使用量が負の値です")
                     silos[silo_data['name']] = SiloData(
                         silo_data['name'],
-                        silo_data['capacity'],
-                        silo_data['current_stock'],
-                        silo_data['daily_usage']
+                        int(silo_data['capacity']),
+                        int(silo_data['current_stock']),
+                        int(silo_data['daily_usage'])
                     )
                 
                 st.success(f"✅ {len(silos)}個のサイロデータを読み込みました")
                 
                 # 読み込んだデータを表示
                 st.subheader("📊 読み込みデータ")
-                silo_df = pd.DataFrame([
-                    {
-                        'サイロ名': silo.name,
-                        '容量': silo.capacity,
-                        '現在在庫': silo.current_stock,
-                        '1日使用量': silo.daily_usage,
-                        '使用率': f"{(silo.current_stock/silo.capacity)*100:.1f}%"
-                    }
-                    for silo in silos.values()
-                ])
+                silo_list = list(silos.values())
+                silo_df = pd.DataFrame({
+                    'サイロ名': [silo.name for silo in silo_list],
+                    '容量': [silo.capacity for silo in silo_list],
+                    '現在在庫': [silo.current_stock for silo in silo_list],
+                    '1日使用量': [silo.daily_usage for silo in silo_list],
+                    '使用率': [f"{(silo.current_stock/silo.capacity)*100:.1f}%" for silo in silo_list]
+                })
                 st.dataframe(silo_df)
                 
             except Exception as e:
@@ -199,20 +417,19 @@ def main():
         if len(silos) < 2:
             st.error("❌ 最低2つのサイロが必要です")
             return
+        if len(silos) > MAX_SILOS:
+            st.error(f"❌ サイロは最大{MAX_SILOS}個までです")
+            return
         
         with st.spinner("計算中..."):
-            optimizer = RouteOptimizer(silos, berth_change_cost, delivery_capacity)
-            route_plans = optimizer.generate_route_plans(max_berth_changes)
-            
-            # 全ルートを評価
-            results = []
-            for route in route_plans:
-                result = optimizer.evaluate_route(route, start_date)
-                if result['feasible']:
-                    results.append(result)
-            
-            # 結果をコストで並び替え
-            results.sort(key=lambda x: x['total_cost_usd'])
+            # サイロ情報をキャッシュキーとして使えるタプルに変換
+            silos_tuple = tuple(
+                (silo.name, silo.capacity, silo.current_stock, silo.daily_usage)
+                for silo in silos.values()
+            )
+            results = run_optimization(
+                silos_tuple, max_berth_changes, berth_change_cost, delivery_capacity, start_date, usd_jpy_rate
+            )
         
         # 結果表示
         st.header("📈 最適化結果")
@@ -222,16 +439,14 @@ def main():
             return
         
         # 結果サマリー
-        summary_df = pd.DataFrame([
-            {
-                'ランク': i+1,
-                'ルート': ' → '.join(result['route']),
-                'バース変更回数': len(result['route']) - 1,
-                'コスト (USD)': f"${result['total_cost_usd']:,.0f}",
-                'コスト (JPY)': f"¥{result['total_cost_jpy']:,.0f}"
-            }
-            for i, result in enumerate(results[:10])  # 上位10件
-        ])
+        top_results = results[:10]  # 上位10件
+        summary_df = pd.DataFrame({
+            'ランク': list(range(1, len(top_results) + 1)),
+            'ルート': [' → '.join(result['route']) for result in top_results],
+            'バース変更回数': [len(result['route']) - 1 for result in top_results],
+            'コスト (USD)': [f"${result['total_cost_usd']:,.0f}" for result in top_results],
+            'コスト (JPY)': [f"¥{result['total_cost_jpy']:,.0f}" for result in top_results]
+        })
         
         st.subheader("🏆 最適ルート一覧")
         st.dataframe(summary_df)
@@ -262,12 +477,12 @@ def main():
         
         # 保存用データ作成
         save_data = {
-            'timestamp': datetime.now().isoformat(),
+            'timestamp': datetime.now(),
             'settings': {
                 'max_berth_changes': max_berth_changes,
                 'berth_change_cost': berth_change_cost,
                 'delivery_capacity': delivery_capacity,
-                'start_date': start_date.isoformat()
+                'start_date': start_date
             },
             'silos': [
                 {
@@ -283,10 +498,10 @@ def main():
         
         if st.button("📥 結果をダウンロード"):
             # JSONファイルとしてダウンロード
-            json_str = json.dumps(save_data, indent=2, ensure_ascii=False)
+            json_bytes = orjson.dumps(save_data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
             st.download_button(
                 label="💾 結果データダウンロード",
-                data=json_str,
+                data=json_bytes,
                 file_name=f"corn_ship_optimization_{start_date.strftime('%Y%m%d')}.json",
                 mime="application/json"
             )